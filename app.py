@@ -1,9 +1,20 @@
+# 重量级依赖（supabase / PIL / httpx / imagehash）都延迟到第一次用到时再 import，
+# 页面首次渲染不用先等它们全部加载完
 import streamlit as st
-import requests
-import json
-import base64
+import orjson
+try:
+    import pybase64 as base64  # SIMD 加速，编码大图快几倍；没装就退回标准库
+except ImportError:
+    import base64
+import hashlib
+import io
+import re
 import time
-from supabase import create_client
+import concurrent.futures
+import functools
+import random
+import threading
+import cachetools
 
 # --- 1. 页面配置 ---
 st.set_page_config(page_title="AI 饮食日记 (防繁忙版)", page_icon="🛡️")
@@ -14,51 +25,324 @@ if "gemini" not in st.secrets or "supabase" not in st.secrets:
     st.stop()
 
 # 初始化数据库
+@st.cache_resource
+def get_supabase():
+    # 进程内单例：避免每次 rerun 都重建客户端、重新握手
+    from supabase import create_client
+    return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+
 try:
-    supabase = create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+    supabase = get_supabase()
 except Exception as e:
     st.error(f"❌ 数据库连接失败: {e}")
     st.stop()
 
+# Storage 公开访问前缀：算一次存成常量，省得每次上传都查 secrets 再拼字符串
+STORAGE_PUBLIC_URL = f"{st.secrets['supabase']['url']}/storage/v1/object/public/food-images"
+
 # --- 2. 核心逻辑 ---
 
-def get_proxies():
+@st.cache_resource
+def get_ai_cache():
+    # 识别结果缓存：同一张图 10 分钟内不再重复调用 Gemini。
+    # cache_resource 保证跨 rerun / 跨会话共享同一个实例；TTLCache 本身
+    # 不是线程安全的（读也会改内部链表），所以和 inflight/breaker 一样带把锁
+    return {"lock": threading.Lock(), "cache": cachetools.TTLCache(maxsize=512, ttl=600)}
+
+@functools.lru_cache(maxsize=1)
+def get_proxy():
+    # secrets 是读 toml，查一次记住就行
     if "proxy" in st.secrets and st.secrets["proxy"]["url"]:
-        p = st.secrets["proxy"]["url"]
-        return {"http": p, "https": p}
+        return st.secrets["proxy"]["url"]
     return None
 
-def call_gemini_api(image_bytes, mime_type, model_name):
-    api_key = st.secrets["gemini"]["api_key"]
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-    
+@functools.lru_cache(maxsize=1)
+def get_api_key():
+    return st.secrets["gemini"]["api_key"]
+
+@st.cache_resource
+def get_http_client():
+    # 连接池 + HTTP/2：Gemini 调用复用同一条连接，省掉每次的 TCP/TLS 握手。
+    # 连接超时单独压到 5s：握手都握不上的死路早点放弃，别占着 60s 的推理预算
+    import httpx
+    return httpx.Client(http2=True, timeout=httpx.Timeout(60, connect=5), proxy=get_proxy())
+
+@st.cache_resource
+def warm_gemini_connection():
+    # 首次加载页面时就在后台把到 Google 的连接握好手，
+    # 等用户点"识别"时连接池里已经有现成的热连接
+    client = get_http_client()
+    api_key = get_api_key()
+    def _warm():
+        try:
+            client.get(
+                "https://generativelanguage.googleapis.com/v1beta/models",
+                params={"key": api_key, "pageSize": 1},
+                timeout=10
+            )
+        except Exception:
+            pass  # 纯预热，失败无所谓
+    threading.Thread(target=_warm, daemon=True).start()
+    return True
+
+warm_gemini_connection()
+
+def compress_image(image_bytes, mime_type):
+    """压缩上传图：缩到 1024px 以内并转 JPEG。手机原图动辄几 MB，
+    压完只剩几十 KB，base64、Gemini 和 Storage 三边都省。"""
+    from PIL import Image
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        # MIME 以字节里探出来的真实格式为准：浏览器报的 type 偶尔是错的
+        # （改过扩展名的文件、某些安卓相册），喂错 mime 会让 Gemini 直接 400
+        real_mime = Image.MIME.get(img.format, mime_type)
+        if img.width <= 1024 and img.height <= 1024 and real_mime == "image/jpeg":
+            return image_bytes, real_mime
+        img.thumbnail((1024, 1024))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        return buf.getvalue(), "image/jpeg"
+    except Exception:
+        # 图片打不开就原样发，交给 Gemini 自己报错
+        return image_bytes, mime_type
+
+def get_upload_bytes(uploaded_file):
+    # 同一次上传在多次 rerun 之间复用压缩结果和哈希：
+    # 不再每次点按钮都 getvalue() 拷一份原图、压一遍、再算一次摘要
+    cached = st.session_state.get("upload_cache")
+    if cached and cached[0] == uploaded_file.file_id:
+        return cached[1], cached[2], cached[3]
+    img_bytes, mime_type = compress_image(uploaded_file.getvalue(), uploaded_file.type)
+    img_hash = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+    st.session_state["upload_cache"] = (uploaded_file.file_id, img_bytes, mime_type, img_hash)
+    return img_bytes, mime_type, img_hash
+
+def perceptual_key(image_bytes):
+    # 感知哈希：同一盘菜连拍两张、或同图不同压缩，phash 相同或只差几位，
+    # 可以作为精确哈希之外的第二层缓存键
+    try:
+        import imagehash
+        from PIL import Image
+        return "phash:" + str(imagehash.phash(Image.open(io.BytesIO(image_bytes))))
+    except Exception:
+        return None
+
+PHASH_MAX_DISTANCE = 6  # 汉明距离阈值：换个角度/光线的同一道菜大致落在这个范围内
+
+def find_similar_cached(cache, phash):
+    """pHash 近邻查找：线性扫缓存里的 phash 条目，汉明距离 <= 阈值就算同一道菜。
+    缓存封顶 512 条，扫一遍是微秒级，不值得上 BK-tree。调用方需持有缓存锁。"""
+    if phash is None:
+        return None
+    import imagehash
+    target = imagehash.hex_to_hash(phash[len("phash:"):])
+    for key in list(cache.keys()):
+        if not isinstance(key, str) or not key.startswith("phash:"):
+            continue
+        try:
+            if target - imagehash.hex_to_hash(key[len("phash:"):]) <= PHASH_MAX_DISTANCE:
+                return cache[key]
+        except Exception:
+            continue  # 条目刚好过期或键格式不对，跳过
+    return None
+
+def is_plausible_photo(image_bytes):
+    """本地快速预检：太小或基本纯色的图（误触拍了黑屏、截图底色）
+    不可能识别出食物，直接拦下，不浪费一次多秒的 Gemini 调用。"""
+    from PIL import Image
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if img.width < 64 or img.height < 64:
+            return False
+        extrema = img.convert("RGB").resize((32, 32)).getextrema()
+        if all(hi - lo < 10 for lo, hi in extrema):
+            return False
+        return True
+    except Exception:
+        return True  # 看不懂的格式放行，让 Gemini 决定
+
+# 用 Gemini 原生的 responseSchema 约束输出结构，不再靠提示词求它"别带 Markdown"
+FOOD_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "food_name": {"type": "STRING", "description": "菜名"},
+        "calories": {"type": "INTEGER", "description": "整数热量"},
+        "nutrients": {"type": "STRING", "description": "营养成分"},
+        "analysis": {"type": "STRING", "description": "简短评价"}
+    },
+    "required": ["food_name", "calories", "nutrients", "analysis"]
+}
+
+def build_request_body(image_bytes, mime_type):
+    """base64 编码 + 序列化只做一次：并发梯队和串行兜底共用同一份请求体"""
     base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    
     payload = {
         "contents": [{
             "parts": [
-                {"text": "你是一个营养师。请识别图片食物，返回纯JSON（无Markdown）：{\"food_name\":\"菜名\", \"calories\":整数热量, \"nutrients\":\"营养成分\", \"analysis\":\"简短评价\"}"},
+                {"text": "你是一个营养师。请识别图片里的食物并给出热量和营养分析，评价控制在一两句话。"},
                 {"inline_data": {"mime_type": mime_type, "data": base64_image}}
             ]
-        }]
+        }],
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": FOOD_SCHEMA,
+            # 封顶输出长度：答案本身几十 token 就够了，留的余量是给 2.5 系列的思考 token
+            "maxOutputTokens": 1024
+        }
     }
+    # orjson 直接出 bytes，跳过 stdlib json.dumps 的中间字符串
+    return orjson.dumps(payload)
+
+def call_gemini_api(body, model_name):
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={get_api_key()}"
 
+    import httpx
     try:
-        response = requests.post(
-            url, 
-            json=payload, 
-            headers={"Content-Type": "application/json"}, 
-            timeout=60, 
-            proxies=get_proxies()
+        client = get_http_client()
+        req = client.build_request(
+            "POST", url,
+            content=body,
+            headers={"Content-Type": "application/json"}
         )
-        return response
-    except requests.exceptions.ConnectionError:
+        response = client.send(req, stream=True)
+        if response.status_code == 200:
+            response.read()
+            return response
+        # 非 200：报错体可能是一大段 HTML/JSON，debug 只需要开头，最多读 2KB 就掐断
+        body = b""
+        for chunk in response.iter_bytes():
+            body += chunk
+            if len(body) >= 2048:
+                break
+        response.close()
+        # iter_bytes() 吐的是解压后的内容，原样照搬响应头的话 httpx 会按
+        # Content-Encoding 再解一次压，直接 DecodingError；Content-Length
+        # 截断后也不对了。这几个实体头剥掉，其余（如 Retry-After）照抄
+        headers = {
+            k: v for k, v in response.headers.items()
+            if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=headers,
+            content=body[:2048]
+        )
+    except httpx.TransportError:
         return None
 
-def analyze_smartly(image_bytes, mime_type):
+# 这些状态码换模型也救不回来（key 无效 / 无权限 / 请求本身非法），重试纯属浪费
+NON_RETRYABLE_CODES = {400, 401, 403}
+
+# 兜底用：剥掉 Markdown 代码围栏的预编译正则（一次 sub，不再链式 replace）
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+def parse_gemini_response(resp):
+    """解析 200 响应；安全拦截或 JSON 不合法时抛异常"""
+    res_json = orjson.loads(resp.content)
+    # 检查是否有内容被安全拦截
+    if not res_json.get('candidates'):
+        raise ValueError("拒绝回答 (安全拦截)")
+    # responseMimeType=application/json 保证返回就是裸 JSON
+    text = res_json['candidates'][0]['content']['parts'][0]['text']
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        # 个别模型不理会 responseMimeType 还是包了围栏，正则兜底剥一次
+        return orjson.loads(_JSON_FENCE_RE.sub("", text.strip()))
+
+@st.cache_resource
+def get_inflight():
+    # 正在识别中的图片哈希（跨 rerun / 跨会话共享）：
+    # 同一张图只允许一个在途请求，重复点击不再多打一次 API
+    return {"lock": threading.Lock(), "keys": set()}
+
+def analyze_smartly(image_bytes, mime_type, img_hash):
     """
     智能分析：防 429 繁忙优化版
     """
+    # 先查缓存：同一张图直接返回上次的结果，省掉几秒的远程推理。
+    # 缓存键直接用 get_upload_bytes 算好的摘要，和存储路径、image_hash 列同源
+    ai_cache = get_ai_cache()
+    cache_key = img_hash
+    phash = perceptual_key(image_bytes)
+    cached = None
+    with ai_cache["lock"]:
+        for key in (cache_key, phash):
+            if key is not None and key in ai_cache["cache"]:
+                cached = ai_cache["cache"][key]
+                break
+        else:
+            # 精确键都没中：按汉明距离找近邻，抓"同一道菜换个角度"的情况
+            cached = find_similar_cached(ai_cache["cache"], phash)
+    if cached is not None:
+        st.toast("⚡ 命中缓存，跳过 AI 调用")
+        return cached
+
+    # single-flight：这张图已经有请求在路上了，别再发第二个
+    inflight = get_inflight()
+    with inflight["lock"]:
+        if cache_key in inflight["keys"]:
+            st.info("⏳ 这张图已经在识别中了，稍等片刻再点一次就能直接命中缓存。")
+            return None
+        inflight["keys"].add(cache_key)
+
+    try:
+        result = run_model_loop(image_bytes, mime_type)
+    finally:
+        with inflight["lock"]:
+            inflight["keys"].discard(cache_key)
+
+    if result is not None:
+        with ai_cache["lock"]:
+            ai_cache["cache"][cache_key] = result
+            if phash is not None:
+                ai_cache["cache"][phash] = result
+    return result
+
+BREAKER_COOLDOWN = 60   # 秒：模型被熔断后的停用时长
+BREAKER_STRIKES = 2     # 连续几次繁忙就熔断
+
+@st.cache_resource
+def get_breaker():
+    # 每个模型一个熔断器：短时间内连吃 429/503 的模型先停用一会儿，
+    # 不再为注定繁忙的候选浪费整个 round-trip
+    return {"lock": threading.Lock(), "until": {}, "strikes": {}}
+
+def breaker_allows(model):
+    b = get_breaker()
+    with b["lock"]:
+        return time.time() >= b["until"].get(model, 0)
+
+def breaker_record(model, busy):
+    b = get_breaker()
+    with b["lock"]:
+        if not busy:
+            b["strikes"][model] = 0
+            return
+        b["strikes"][model] = b["strikes"].get(model, 0) + 1
+        if b["strikes"][model] >= BREAKER_STRIKES:
+            b["until"][model] = time.time() + BREAKER_COOLDOWN
+            b["strikes"][model] = 0
+
+@st.cache_data(ttl=3600)
+def get_available_models():
+    """探测一次可用模型列表（每小时刷新）；探测失败返回 None 表示不过滤"""
+    try:
+        resp = get_http_client().get(
+            "https://generativelanguage.googleapis.com/v1beta/models",
+            params={"key": get_api_key(), "pageSize": 100},
+            timeout=10
+        )
+        if resp.status_code != 200:
+            return None
+        return {m["name"].split("/")[-1] for m in orjson.loads(resp.content).get("models", [])}
+    except Exception:
+        return None
+
+def run_model_loop(image_bytes, mime_type):
+    """按梯队轮询候选模型，拿到第一个能解析的结果就返回"""
     # 策略调整：先用 Flash (额度高/速度快) 保底，再尝试 Pro
     models_candidates = [
         "gemini-2.5-flash",       # 速度快，额度通常较高
@@ -66,14 +350,64 @@ def analyze_smartly(image_bytes, mime_type):
         "gemini-2.5-pro",         # 最强模型 (容易 429，放后面试)
         "gemini-flash-latest"     # 最后的保底
     ]
-    
+
+    # 候选名单先过一遍可用模型列表：不存在的名字直接剔掉，省下注定 404 的 round-trip
+    available = get_available_models()
+    if available:
+        filtered = [m for m in models_candidates if m in available]
+        if filtered:
+            models_candidates = filtered
+
+    # 熔断中的模型先让开；要是全被熔断了就只能照旧全试
+    open_models = [m for m in models_candidates if breaker_allows(m)]
+    if open_models:
+        models_candidates = open_models
+
     last_debug_info = ""
+    body = build_request_body(image_bytes, mime_type)
+
+    # 第一梯队：两个 Flash 并发竞速，谁先出结果用谁，省一轮串行等待。
+    # 线程里只做网络调用，Streamlit UI 全留在主线程。
+    first_wave, backups = models_candidates[:2], models_candidates[2:]
+    with st.status(f"🤖 正在并发呼叫 {' / '.join(first_wave)}...", expanded=False) as status:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(first_wave))
+        futures = {pool.submit(call_gemini_api, body, m): m for m in first_wave}
+        try:
+            for fut in concurrent.futures.as_completed(futures):
+                model = futures[fut]
+                resp = fut.result()
+                if resp is not None:
+                    breaker_record(model, resp.status_code in (429, 503))
+                if resp is None:
+                    last_debug_info += f"\n{model}: 连接失败"
+                elif resp.status_code == 200:
+                    try:
+                        result = parse_gemini_response(resp)
+                        status.update(label=f"✅ {model} 识别成功！", state="complete")
+                        return result
+                    except Exception as e:
+                        last_debug_info += f"\n{model} 解析错误: {e}"
+                elif resp.status_code == 429:
+                    last_debug_info += f"\n{model}: 429 繁忙"
+                elif resp.status_code in NON_RETRYABLE_CODES:
+                    status.update(label=f"❌ 请求被拒 ({resp.status_code})，检查 API Key", state="error")
+                    st.error(f"❌ Gemini 返回 {resp.status_code}：{resp.text}")
+                    return None
+                else:
+                    last_debug_info += f"\n{model}: 报错 {resp.status_code} {resp.text}"
+            status.update(label="⏳ Flash 梯队没拿到结果，转入兜底模型...", state="error")
+        finally:
+            # 赢家已出就不等输家跑完，直接放弃剩余请求
+            pool.shutdown(wait=False, cancel_futures=True)
 
-    for model in models_candidates:
+    # 第二梯队：串行兜底。Pro 容易 429，并发去打只会浪费额度
+    for model in backups:
         # 每个模型只试 1 次，不行就换，不死磕
         with st.status(f"🤖 正在呼叫 {model}...", expanded=False) as status:
-            resp = call_gemini_api(image_bytes, mime_type, model)
-            
+            resp = call_gemini_api(body, model)
+            if resp is not None:
+                breaker_record(model, resp.status_code in (429, 503))
+
             # 1. 网络挂了
             if resp is None:
                 st.error("无法连接 Google。请检查代理设置。")
@@ -82,64 +416,122 @@ def analyze_smartly(image_bytes, mime_type):
             # 2. 成功
             if resp.status_code == 200:
                 try:
-                    res_json = resp.json()
-                    # 检查是否有内容被安全拦截
-                    if not res_json.get('candidates'):
-                        status.update(label=f"⚠️ {model} 拒绝回答 (安全拦截)", state="error")
-                        continue
-
-                    text = res_json['candidates'][0]['content']['parts'][0]['text']
-                    clean_text = text.replace("```json", "").replace("```", "").strip()
+                    result = parse_gemini_response(resp)
                     status.update(label=f"✅ {model} 识别成功！", state="complete")
-                    return json.loads(clean_text)
+                    return result
                 except Exception as e:
                     status.update(label=f"⚠️ {model} 数据解析错误", state="error")
                     last_debug_info += f"\n{model} 解析错误: {e}"
 
-            # 3. 繁忙 (429) -> 核心修改：遇到繁忙直接换下一个模型，不等待
+            # 3. 繁忙 (429)：服务端明说几秒内有空就等一下重试一次，否则直接换模型
             elif resp.status_code == 429:
+                wait = None
+                try:
+                    wait = float(resp.headers.get("retry-after"))
+                except (TypeError, ValueError):
+                    pass
+                if wait is not None and wait <= 5:
+                    # 按 Retry-After 等待 + 随机抖动，避免和别人同一瞬间挤回去
+                    status.update(label=f"⏳ {model} 繁忙，{wait:.0f}s 后重试一次...", state="running")
+                    time.sleep(wait + random.uniform(0, 0.5))
+                    resp = call_gemini_api(body, model)
+                    if resp is not None and resp.status_code == 200:
+                        try:
+                            result = parse_gemini_response(resp)
+                            status.update(label=f"✅ {model} 识别成功！", state="complete")
+                            return result
+                        except Exception as e:
+                            last_debug_info += f"\n{model} 解析错误: {e}"
                 status.update(label=f"⏳ {model} 太忙了 (429)，尝试下一个...", state="error")
-                # 这里不 sleep 了，直接换下一个模型试试运气
-                continue 
-            
-            # 4. 其他错误
+                continue
+
+            # 4. 不可重试的 4xx：再换模型也没用，直接收工
+            elif resp.status_code in NON_RETRYABLE_CODES:
+                status.update(label=f"❌ 请求被拒 ({resp.status_code})，检查 API Key", state="error")
+                st.error(f"❌ Gemini 返回 {resp.status_code}：{resp.text}")
+                return None
+
+            # 5. 其他错误（404 模型名不存在等）：跳过这个模型继续
             else:
                 status.update(label=f"❌ {model} 报错 {resp.status_code}", state="error")
                 last_debug_info += f"\n{model}: {resp.text}"
-    
+
     # 如果循环完了还没成功，说明彻底被限制了
     st.error("❌ 所有模型目前都太忙 (429)。请等待 1 分钟后再试。")
     if last_debug_info:
         with st.expander("查看报错详情"):
             st.code(last_debug_info)
-            
+
     return None
 
 # --- 3. UI 部分 ---
-def upload_img(file_bytes, name, mime_type):
+def upload_img(file_bytes, mime_type, img_hash):
+    # 内容寻址命名：文件名就是内容的 blake2b 摘要（get_upload_bytes 算好的那份），
+    # 同一张图永远落在同一个路径，重复上传直接复用已有对象
     ext = mime_type.split('/')[-1]
     if ext == 'jpeg': ext = 'jpg'
-    path = f"{int(time.time())}_{name}"
-    if not path.endswith(f".{ext}"): path += f".{ext}"
+    path = f"{img_hash}.{ext}"
+    public_url = f"{STORAGE_PUBLIC_URL}/{path}"
     try:
         supabase.storage.from_("food-images").upload(path, file_bytes, {"content-type": mime_type})
-        return f"{st.secrets['supabase']['url']}/storage/v1/object/public/food-images/{path}"
-    except: return None
+        return public_url
+    except Exception as e:
+        # 对象已存在 = 同一张图之前传过，URL 照样有效
+        if "exists" in str(e).lower() or "duplicate" in str(e).lower():
+            return public_url
+        return None
 
-def save_to_db(data, url):
+def save_to_db(data, url, img_hash):
+    # 先进队列再整批写：一次 insert 可以带多行，上次网络抖动没写进去的记录也会顺带补上
+    queue = st.session_state.setdefault("pending_meals", [])
+    queue.append({
+        "food_name": data.get("food_name", "未命名"),
+        "calories": data.get("calories", 0),
+        "nutrients": data.get("nutrients", ""),
+        "analysis": data.get("analysis", ""),
+        "image_url": url if url else "",
+        "image_hash": img_hash
+    })
     try:
-        supabase.table("meals").insert({
-            "food_name": data.get("food_name", "未命名"),
-            "calories": data.get("calories", 0),
-            "nutrients": data.get("nutrients", ""),
-            "analysis": data.get("analysis", ""),
-            "image_url": url if url else ""
-        }).execute()
+        # upsert + ON CONFLICT(image_hash)：补写队列重发同一条记录时不会插出重复行
+        # （需要 meals 表有 image_hash 列和唯一索引）
+        res = supabase.table("meals").upsert(
+            list(queue), on_conflict="image_hash", ignore_duplicates=True
+        ).execute()
+        queue.clear()
+        # PostgREST 的 insert 默认带 returning=representation：
+        # 新行就在响应里，直接并进本地历史，省掉一次回读 SELECT
+        if res.data:
+            optimistic = st.session_state.setdefault("optimistic_meals", [])
+            optimistic[:0] = res.data
+            del optimistic[3:]
         return True
     except: return False
 
+def thumb_html(url):
+    # 让浏览器自己去 Supabase CDN 拉图：懒加载 + 客户端缓存，
+    # 图片字节不再流经 Streamlit 服务端。优先要 240px 的服务端缩略图
+    # （render/image 转换端点），项目不支持就 onerror 退回原图
+    thumb_url = url.replace("/object/public/", "/render/image/public/") + "?width=240"
+    return (
+        f'<img src="{thumb_url}" loading="lazy" width="120" style="border-radius:8px" '
+        f'onerror="this.onerror=null;this.src=\'{url}\'">'
+    )
+
+@st.cache_data(ttl=30)
+def get_recent_meals(limit=3):
+    # 30 秒内的 rerun 直接用缓存，不再每次都打一次数据库；
+    # 只取要渲染的列，不用 select("*") 把整行都拖回来
+    return supabase.table("meals").select(
+        "id,food_name,calories,nutrients,analysis,image_url"
+    ).order("created_at", desc=True).limit(limit).execute().data
+
 st.title("🥗 AI 饮食记录")
 
+if "last_saved" in st.session_state:
+    st.balloons()
+    st.success(st.session_state.pop("last_saved"))
+
 with st.sidebar:
     st.info("💡 如果一直提示繁忙，请等待 1 分钟释放额度。")
 
@@ -150,26 +542,41 @@ if uploaded_file:
     
     # 增加一个 Key 来强制刷新按钮状态
     if st.button("🚀 立即识别", type="primary"):
-        img_bytes = uploaded_file.getvalue()
-        
-        # 增加一个延时，防止用户狂点按钮
-        with st.spinner("正在连接 AI..."):
-            time.sleep(1) 
-            result = analyze_smartly(img_bytes, uploaded_file.type)
-        
-        if result:
-            url = upload_img(img_bytes, uploaded_file.name, uploaded_file.type)
-            if save_to_db(result, url):
-                st.balloons()
-                st.success(f"已记录：{result['food_name']} ({result['calories']} kcal)")
-                time.sleep(2)
-                st.rerun()
+        img_bytes, mime_type, img_hash = get_upload_bytes(uploaded_file)
+
+        if not is_plausible_photo(img_bytes):
+            # 只跳过识别/保存，不 st.stop()：下面的历史记录照常渲染
+            st.warning("🤔 这张图太小或接近纯色，看起来不像食物照片，已跳过识别。")
+        else:
+            # 上传 Storage 不依赖识别结果，丢到后台线程和 AI 调用并行跑
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                upload_future = pool.submit(upload_img, img_bytes, mime_type, img_hash)
+
+                with st.spinner("正在连接 AI..."):
+                    result = analyze_smartly(img_bytes, mime_type, img_hash)
+
+                url = upload_future.result()
+
+            if result:
+                if save_to_db(result, url, img_hash):
+                    # 不再原地 sleep(2)：把提示寄存到 session_state，rerun 后再放
+                    st.session_state["last_saved"] = f"已记录：{result['food_name']} ({result['calories']} kcal)"
+                    st.rerun()
 
 st.divider()
 try:
-    rows = supabase.table("meals").select("*").order("created_at", desc=True).limit(3).execute().data
-    for row in rows:
+    # 乐观并入刚写进去的行（insert 的 returning 结果），再补上缓存里的历史，按 id 去重
+    rows, seen = [], set()
+    for row in st.session_state.get("optimistic_meals", []) + get_recent_meals():
+        key = row.get("id") or row.get("image_hash")
+        if key in seen:
+            continue
+        seen.add(key)
+        rows.append(row)
+    for row in rows[:3]:
         with st.container(border=True):
+            if row.get("image_url"):
+                st.markdown(thumb_html(row["image_url"]), unsafe_allow_html=True)
             st.markdown(f"**{row['food_name']}**")
             st.caption(f"{row['calories']} kcal | {row['analysis']}")
 except: pass